@@ -21,11 +21,9 @@ class ConfigNamespace(object):
     yielding name, value pairs.
     """
     def __init__(self, mapping):
-        self._mapping = {}
-        for name, value in mapping.items():
-            self._mapping[name] = value
-            name = name.replace("-", "_")
-            setattr(self, name, value)
+        self._mapping = dict(mapping)
+        # populate attributes in one bulk update rather than a setattr() per key
+        self.__dict__.update((name.replace("-", "_"), value) for name, value in self._mapping.items())
     def get(self, key, default=None):
         return self._mapping.get(key, default)
     def items(self):
@@ -33,7 +31,8 @@ class ConfigNamespace(object):
 
 # load config into a config namespace, and config["parameters"] into a parameters namespace
 with open(CONFIG, "r") as _std:
-    config = ConfigNamespace(yaml.safe_load(_std))
+    # use the libyaml-backed loader when available, it is considerably faster than the pure-Python one
+    config = ConfigNamespace(yaml.load(_std, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader)))
 
     parameters_dict = OrderedDict()
     parameters_prefix = OrderedDict()
@@ -68,7 +67,10 @@ def init_logger(name="STIMELA",
 
         log_colourful_formatter = ColorizingFormatter(col_fmt, datefmt, style="{")
 
-        log_formatter = log_colourful_formatter
+        # subprocess output is passed through as is, as if the cab had written it directly
+        log_subprocess_formatter = logging.Formatter("{message}", style="{")
+
+        log_formatter = SelectiveFormatter(log_colourful_formatter, [(_is_from_subprocess, log_subprocess_formatter)])
 
         log_console_handler = MultiplexingHandler()
         log_console_handler.setFormatter(log_formatter)
@@ -81,17 +83,54 @@ log = None
 if log is None:
     log = init_logger()
 
+def _format_memory(kib):
+    """Formats an amount of memory given in KiB in the human-readable style of 'free -h'"""
+    if not kib:
+        return "0B"
+    size = float(kib)
+    for unit in ("Ki", "Mi", "Gi", "Ti"):
+        if size < 1024:
+            break
+        size /= 1024
+    return f"{size:.1f}{unit}" if size < 10 else f"{size:.0f}{unit}"
+
+def _meminfo_report():
+    """Reads /proc/meminfo and returns memory status as a list of lines in the same layout as 'free -h'"""
+    meminfo = {}
+    with open("/proc/meminfo") as f:
+        for line in f:
+            name, value = line.split(":", 1)
+            meminfo[name] = int(value.split()[0])
+    buffcache = meminfo["Buffers"] + meminfo["Cached"] + meminfo.get("SReclaimable", 0)
+    available = meminfo.get("MemAvailable", meminfo["MemFree"])
+    mem = [meminfo["MemTotal"], meminfo["MemTotal"] - available, meminfo["MemFree"],
+           meminfo.get("Shmem", 0), buffcache, available]
+    swap = [meminfo["SwapTotal"], meminfo["SwapTotal"] - meminfo["SwapFree"], meminfo["SwapFree"]]
+    header = ["total", "used", "free", "shared", "buff/cache", "available"]
+    return [" " * 8 + "".join(f"{col:>12}" for col in header),
+            "Mem:    " + "".join(f"{_format_memory(x):>12}" for x in mem),
+            "Swap:   " + "".join(f"{_format_memory(x):>12}" for x in swap)]
+
 def report_memory():
     """Reports memory status"""
     try:
-        output = subprocess.check_output(["/usr/bin/free", "-h"]).decode().splitlines(keepends=False)
-    except subprocess.CalledProcessError as exc:
-        log.warning(f"/usr/bin/free -h exited with code {exc.returncode}")
-        return
+        output = _meminfo_report()
+    except (OSError, ValueError, IndexError, KeyError):
+        # no usable /proc/meminfo (e.g. not Linux), fall back to the free utility
+        try:
+            output = subprocess.check_output(["/usr/bin/free", "-h"]).decode().splitlines(keepends=False)
+        except subprocess.CalledProcessError as exc:
+            log.warning(f"/usr/bin/free -h exited with code {exc.returncode}")
+            return
+        except OSError as exc:
+            log.warning(f"unable to report memory status: {exc}")
+            return
     for line in output:
         log.info(line)
 
-log.info("Initial memory state:")
-report_memory()
+# reporting memory at import time is opt-in, cabs may call report_memory() explicitly instead
+if os.environ.get("SCABHA_REPORT_MEMORY_AT_IMPORT", "").strip().lower() not in ("", "0", "false", "no"):
+    log.info("Initial memory state:")
+    report_memory()
 
 from .proc_utils import prun, prun_multi, clear_junk, parse_parameters
@@ -3,7 +3,8 @@ import sys
 import logging
 
 class MultiplexingHandler(logging.Handler):
-    """handler to send INFO and below to stdout, everything above to stderr"""
+    """handler to send INFO and below to stdout, everything above to stderr. Subprocess output records
+    go to the stream they were read from."""
     def __init__(self, info_stream=sys.stdout, err_stream=sys.stderr):
         super(MultiplexingHandler, self).__init__()
         self.info_handler = logging.StreamHandler(info_stream)
@@ -11,8 +12,21 @@ class MultiplexingHandler(logging.Handler):
         self.multiplex = True
 
     def emit(self, record):
-        handler = self.err_handler if record.levelno > logging.INFO and self.multiplex else self.info_handler
-        handler.emit(record)
+        from_subprocess = hasattr(record, 'stimela_subprocess_output')
+        # subprocess output goes to the stream it was read from, anything else is split by level
+        if from_subprocess:
+            is_error = record.stimela_subprocess_output[1] == "stderr"
+        else:
+            is_error = record.levelno > logging.INFO
+        handler = self.err_handler if is_error and self.multiplex else self.info_handler
+        # subprocess output carries its own line endings (possibly "\r" for progress updates), so is written as is
+        if from_subprocess:
+            try:
+                handler.stream.write(handler.format(record))
+            except Exception:
+                handler.handleError(record)
+        else:
+            handler.emit(record)
         # ignore broken pipes, this often happens when cleaning up and exiting
         try:
             handler.flush()
@@ -1,80 +1,297 @@
 # -*- coding: future_fstrings -*-
+import logging
 import subprocess
 import shlex
 import glob
+import fnmatch
+import re
 import os.path
+import stat
 import shutil
+import selectors
+import threading
+from collections import OrderedDict
 
 from . import log, OUTPUT, MSDIR, config, parameters_dict, parameters_prefix, parameters_positional
 
 def convert_command(command):
-    """Converts list or str command into a string and a list"""
+    """
+    Converts list or str command into a string and a list.
+    For a list, the string is returned as None, and is only joined up where it is actually needed.
+    """
     if type(command) is str:
         command_list = shlex.split(command)
     elif type(command) is list:
         command_list = command
-        command = ' '.join(command)
+        command = None
     else:
         raise TypeError("command: list or string expected")
     return command, command_list
 
 
+def _log_output(name, stream, data, tag=""):
+    """
+    Passes a chunk of subprocess output straight to the log handlers as a single record, marking it as such.
+    The chunk keeps its own line endings. This bypasses the logger level, so tool output is always shown, as if
+    the tool wrote to the console itself.
+    """
+    text = data.decode(errors="replace")
+    if tag:
+        text = "".join(tag + line for line in text.splitlines(keepends=True))
+    log.handle(log.makeRecord(log.name, logging.INFO, __file__, 0, text, None, None,
+                              extra=dict(stimela_subprocess_output=(name, stream))))
+
+
+class _OutputReader(object):
+    """
+    Reads an output pipe of a command, passing output to the log a chunk at a time.
+    Each chunk is cut after the last line ending (either "\n", or "\r" as used by progress updates).
+    """
+    def __init__(self, pipe, name, stream, tag=""):
+        self.pipe = pipe
+        self.name = name
+        self.stream = stream
+        self.tag = tag
+        self._partial = b""
+
+    def read(self):
+        """
+        Reads available output and logs it.
+        Returns number of bytes read, 0 on EOF (any incomplete last line is logged), or None if nothing is available
+        """
+        try:
+            chunk = os.read(self.pipe.fileno(), 65536)
+        except BlockingIOError:
+            return None
+        data = self._partial + chunk
+        if not chunk:
+            # EOF: log whatever is left, completing the last line
+            if data and not data.endswith((b"\n", b"\r")):
+                data += b"\n"
+            end = len(data)
+        else:
+            end = max(data.rfind(b"\n"), data.rfind(b"\r")) + 1
+            # don't let output without line endings build up indefinitely
+            if not end and len(data) >= 65536:
+                end = len(data)
+        if end:
+            _log_output(self.name, self.stream, data[:end], self.tag)
+        self._partial = data[end:]
+        return len(chunk)
+
+    def drain_in_background(self):
+        """
+        Hands the pipe over to a daemon thread, which keeps logging its output until EOF, then closes it.
+        Used when a command has exited, but a background process it started still holds the pipe.
+        """
+        os.set_blocking(self.pipe.fileno(), True)
+
+        def drain():
+            try:
+                while self.read():
+                    pass
+            finally:
+                self.pipe.close()
+
+        threading.Thread(target=drain, daemon=True).start()
+
+
+# interval (in seconds) at which running commands are checked for exit while waiting on their output
+_POLL_INTERVAL = 0.1
+
+
+def _run_commands(commands, max_parallel=1):
+    """
+    Runs commands given as a list of (command, command_list) tuples, with at most max_parallel running at once.
+    The stdout and stderr pipes of all commands are polled from a single selector loop, with output passed to
+    the log as it arrives. If more than one command can run at a time, messages are tagged with the number and
+    name of the command they come from.
+
+    Returns list of results in the order of commands: None on success, or a subprocess.CalledProcessError instance
+    """
+    results = [None] * len(commands)
+    pending = list(enumerate(commands))[::-1]
+    running = OrderedDict()     # index: Popen object
+    tagged = max_parallel > 1 and len(commands) > 1
+    selector = selectors.DefaultSelector()
+
+    def tag(index):
+        return f"[{index + 1}:{commands[index][1][0]}] " if tagged else ""
+
+    try:
+        while pending or running:
+            # start new commands while there are free slots
+            while pending and len(running) < max_parallel:
+                index, (command, command_list) = pending.pop()
+                if log.isEnabledFor(logging.INFO):
+                    log.info(f"{tag(index)}Running {command or ' '.join(command_list)}")
+                proc = running[index] = subprocess.Popen(command_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                                         bufsize=-1)
+                for stream, pipe in (("stdout", proc.stdout), ("stderr", proc.stderr)):
+                    os.set_blocking(pipe.fileno(), False)
+                    selector.register(pipe, selectors.EVENT_READ,
+                                      (index, _OutputReader(pipe, command_list[0], stream, tag(index))))
+            # time out periodically to check for exited commands: a command may have closed its pipes while it
+            # carries on running, or a background process it started may hold them open after it has finished
+            for key, _ in selector.select(_POLL_INTERVAL):
+                if key.data[1].read() == 0:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+            for index, proc in list(running.items()):
+                if proc.poll() is None:
+                    continue
+                # command has exited: take whatever it left in its pipes without waiting for EOF. If something
+                # else still holds a pipe open, keep passing its output on in the background.
+                for key in [key for key in selector.get_map().values() if key.data[0] == index]:
+                    selector.unregister(key.fileobj)
+                    reader = key.data[1]
+                    while True:
+                        nbytes = reader.read()
+                        if nbytes == 0:
+                            reader.pipe.close()
+                            break
+                        elif nbytes is None:
+                            reader.drain_in_background()
+                            break
+                del running[index]
+                if proc.returncode:
+                    name = commands[index][1][0]
+                    log.error(f"{tag(index)}{name} exited with code {proc.returncode}")
+                    results[index] = subprocess.CalledProcessError(proc.returncode, commands[index][1])
+    finally:
+        # only non-empty if we're bailing out on an exception: don't leave orphans behind
+        for proc in running.values():
+            proc.kill()
+            proc.wait()
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+    return results
+
+
 def prun(command):
     """
     Runs a single command given by a string, or a list (strings will be split into lists by whitespace).
+    Output of the command is passed through the log.
     Calls clear_junk() afterwards.
 
     Returns 0 on success, or a subprocess.CalledProcessError instance on failure.
     """
-    command, command_list = convert_command(command)
-
-    log.info(f"Running {command}")
-    try:
-        subprocess.check_call(command_list)
-    except subprocess.CalledProcessError as exc:
-        log.error(f"{command_list[0]} exited with code {exc.returncode}")
-        clear_junk()
-        return exc
+    exc, = _run_commands([convert_command(command)])
     clear_junk()
-    return 0
+    return exc or 0
 
 
-def prun_multi(commands):
+def prun_multi(commands, max_parallel=None):
     """
     Runs multiple commands given by list.
+    Output of the commands is passed through the log.
     Calls clear_junk() afterwards.
 
-    Returns list of ("command_string", exception) tuples, one for every command that failed.
-    Empty list means all commands succeeded.
+    max_parallel: number of commands to run concurrently. If None, taken from the cab "prun_multi_parallel"
+                  config variable, which defaults to 1, i.e. commands are run one after another.
+                  0 means use all available CPUs. Raises ValueError for anything else that isn't a
+                  non-negative integer.
+
+    Returns list of ("command_string", exception) tuples, one for every command that failed, in the order
+    the commands were given. Empty list means all commands succeeded.
     """
+    if max_parallel is None:
+        max_parallel = config.get("prun_multi_parallel", 1)
+    if type(max_parallel) is not int or max_parallel < 0:
+        raise ValueError(f"max_parallel: non-negative integer expected, got '{max_parallel}'")
+    max_parallel = max_parallel or os.cpu_count() or 1
+    commands = [convert_command(command) for command in commands]
 
-    errors = []
-    for command in commands:
-        command, command_list = convert_command(command)
-        log.info(f"Running {command}")
-        try:
-            subprocess.check_call(command_list)
-        except subprocess.CalledProcessError as exc:
-            log.error(f"{command_list[0]} exited with code {exc.returncode}")
-            errors.append((command, exc))
+    results = _run_commands(commands, max_parallel)
     clear_junk()
-    return errors
+
+    return [(command or ' '.join(command_list), exc) for (command, command_list), exc in zip(commands, results)
+            if exc is not None]
+
+
+def _compile_junk(junk):
+    """
+    Sorts the cab "junk" config variable into literal paths, wildcard patterns with a literal directory
+    part (OR-joined into a single regex per directory), and patterns that need a full glob
+
+    Returns literals, [(dirname, regex)], globs
+    """
+    literals, patterns, globs = [], OrderedDict(), []
+    for item in map(str, junk):
+        dirname, basename = os.path.split(item)
+        if not glob.has_magic(item):
+            literals.append(item)
+        elif glob.has_magic(dirname):
+            globs.append(item)
+        else:
+            regex = f"(?:{fnmatch.translate(basename)})"
+            # like glob, wildcards do not match a leading dot unless the pattern starts with one
+            if not basename.startswith("."):
+                regex = r"(?!\.)" + regex
+            patterns.setdefault(dirname, []).append(regex)
+    patterns = [(dirname, re.compile("|".join(regexes))) for dirname, regexes in patterns.items()]
+    return literals, patterns, globs
+
+_junk_literals, _junk_patterns, _junk_globs = _compile_junk(config.get("junk") or [])
+
+
+def _find_junk(dest):
+    """
+    Finds junk items under directory dest. Only regular files, symlinks and directories are considered.
+
+    Returns OrderedDict of path: is_dir
+    """
+    found = OrderedDict()
+
+    def add_path(path):
+        try:
+            mode = os.lstat(path).st_mode
+        except OSError:
+            return
+        if stat.S_ISLNK(mode) or stat.S_ISREG(mode):
+            found[path] = False
+        elif stat.S_ISDIR(mode):
+            found[path] = True
+
+    # paths are always taken relative to dest, even if a junk item starts with "/"
+    for item in _junk_literals:
+        add_path(f"{dest}/{item}")
+    # one directory scan per literal directory, reusing the stat info cached on each entry
+    for dirname, regex in _junk_patterns:
+        try:
+            entries = list(os.scandir(f"{dest}/{dirname}"))
+        except OSError:
+            continue
+        for entry in entries:
+            if regex.match(entry.name):
+                if entry.is_symlink() or entry.is_file(follow_symlinks=False):
+                    found[entry.path] = False
+                elif entry.is_dir(follow_symlinks=False):
+                    found[entry.path] = True
+    for item in _junk_globs:
+        for path in glob.glob(f"{dest}/{item}"):
+            add_path(path)
+    return found
 
 
 def clear_junk():
     """
     Clears junk output products according to cab "junk" config variable
     """
-    for item in config.get("junk", []):
-        for dest in [OUTPUT, MSDIR]:  # these are the only writable volumes in the container
-            items = glob.glob(f"{dest}/{item}")
-            if items:
-                log.debug(f"clearing junk: {' '.join(items)}")
-                for f in items:
-                    if os.path.islink(f) or os.path.isfile(f):
-                        os.remove(f)
-                    elif os.path.isdir(f):
+    for dest in [OUTPUT, MSDIR]:  # these are the only writable volumes in the container
+        items = _find_junk(dest)
+        if items:
+            log.debug(f"clearing junk: {' '.join(items)}")
+            for f, is_dir in items.items():
+                # an item may already be gone if it was inside a junk directory removed before it
+                try:
+                    if is_dir:
                         shutil.rmtree(f)
+                    else:
+                        os.remove(f)
+                except FileNotFoundError:
+                    pass
 
 def parse_parameters(pardict=None, positional=None, mandatory=None, repeat=True, repeat_dict=None):
     """
@@ -116,14 +333,13 @@ def parse_parameters(pardict=None, positional=None, mandatory=None, repeat=True,
     if missing:
         raise RuntimeError(f"mandatory parameter(s) {' '.join(missing)} missing")
 
-    # positional arguments get removed from dict, so make a copy
+    # positional arguments are handled here and skipped below, so pardict needn't be copied
+    if type(positional) is str: # be defensive in case a single string argument is given
+        positional = [positional]
     if positional:
-        if type(positional) is str: # be defensive in case a single string argument is given
-            positional = [positional]
-        pardict = pardict.copy()
         for key in positional:
             if key in pardict:
-                value = pardict.pop(key)
+                value = pardict[key]
                 if value in [None, False]:
                     continue
                 elif hasattr(value, '__iter__') and type(value) is not str:
@@ -137,10 +353,11 @@ def parse_parameters(pardict=None, positional=None, mandatory=None, repeat=True,
             else:
                 raise NameError(f"positional parameter '{key}' not defined in config")
 
+    positional = set(positional or [])
     args = []
     for key, value in pardict.items():
         # ignore None or False values, they are considered unset
-        if value in [None, False]:
+        if value in [None, False] or key in positional:
             continue
         prefix = parameters_prefix[key]
         option = f'{prefix}{key}'